@@ -7,6 +7,12 @@ resource "aws_lambda_function" "aws_lambda_cnm_responder" {
   runtime          = "python3.9"
   source_code_hash = filebase64sha256("cnm_responder.zip")
   timeout          = 300
+  layers           = ["arn:aws:lambda:${var.aws_region}:345057560386:layer:AWS-Parameters-and-Secrets-Lambda-Extension:${var.parameters_secrets_extension_version}"]
+  environment {
+    variables = {
+      TOPIC_ARN = data.aws_sns_topic.batch_job_failure.arn
+    }
+  }
   vpc_config {
     subnet_ids         = data.aws_subnets.private_application_subnets.ids
     security_group_ids = data.aws_security_groups.vpc_default_sg.ids
@@ -17,19 +23,74 @@ resource "aws_lambda_function" "aws_lambda_cnm_responder" {
   }
 }
 
-resource "aws_lambda_permission" "aws_lambda_cnm_responder_sns" {
-  statement_id  = "AllowExecutionFromSNS"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.aws_lambda_cnm_responder.function_name
-  principal     = "sns.amazonaws.com"
-  source_arn    = data.aws_sns_topic.cnm_response.arn
+resource "aws_lambda_event_source_mapping" "aws_lambda_cnm_responder_sqs" {
+  event_source_arn                   = aws_sqs_queue.cnm_response.arn
+  function_name                      = aws_lambda_function.aws_lambda_cnm_responder.arn
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = 30
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+# CNM Response queue and dead-letter queue
+resource "aws_sqs_queue" "cnm_response" {
+  name                       = "${var.prefix}-cnm-response"
+  visibility_timeout_seconds = 1800
+  redrive_policy = jsonencode({
+    "deadLetterTargetArn" : aws_sqs_queue.cnm_response_dlq.arn,
+    "maxReceiveCount" : 3
+  })
+}
+
+resource "aws_sqs_queue" "cnm_response_dlq" {
+  name                      = "${var.prefix}-cnm-response-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_cloudwatch_metric_alarm" "cnm_response_dlq" {
+  alarm_name          = "${var.prefix}-cnm-response-dlq"
+  alarm_description   = "CNM responses exhausted retries and were moved to the dead-letter queue."
+  namespace           = "AWS/SQS"
+  metric_name         = "ApproximateNumberOfMessagesVisible"
+  dimensions = {
+    QueueName = aws_sqs_queue.cnm_response_dlq.name
+  }
+  statistic           = "Maximum"
+  period              = 300
+  evaluation_periods  = 1
+  threshold           = 0
+  comparison_operator = "GreaterThanThreshold"
+  treat_missing_data  = "notBreaching"
+  alarm_actions       = [data.aws_sns_topic.batch_job_failure.arn]
+}
+
+resource "aws_sqs_queue_policy" "cnm_response" {
+  queue_url = aws_sqs_queue.cnm_response.id
+  policy = jsonencode({
+    "Version" : "2012-10-17",
+    "Statement" : [
+      {
+        "Effect" : "Allow",
+        "Principal" : {
+          "Service" : "sns.amazonaws.com"
+        },
+        "Action" : "sqs:SendMessage",
+        "Resource" : "${aws_sqs_queue.cnm_response.arn}",
+        "Condition" : {
+          "ArnEquals" : {
+            "aws:SourceArn" : "${data.aws_sns_topic.cnm_response.arn}"
+          }
+        }
+      }
+    ]
+  })
 }
 
 # CNM Response topic subscription
 resource "aws_sns_topic_subscription" "sns-topic" {
-  topic_arn = data.aws_sns_topic.cnm_response.arn
-  protocol  = "lambda"
-  endpoint  = aws_lambda_function.aws_lambda_cnm_responder.arn
+  topic_arn            = data.aws_sns_topic.cnm_response.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.cnm_response.arn
+  raw_message_delivery = true
 }
 
 # AWS Lambda role and policy
@@ -57,7 +118,7 @@ resource "aws_iam_role_policy_attachment" "aws_lambda_execution_role_policy_atta
 
 resource "aws_iam_policy" "aws_lambda_execution_policy" {
   name        = "${var.prefix}-lambda-cnm-responder-execution-policy"
-  description = "Write to CloudWatch logs, list and delete from S3."
+  description = "Write to CloudWatch logs, list and delete from S3, receive from SQS."
   policy = jsonencode({
     "Version" : "2012-10-17",
     "Statement" : [
@@ -121,6 +182,16 @@ resource "aws_iam_policy" "aws_lambda_execution_policy" {
         ],
         "Resource" : "${data.aws_s3_bucket.l2p_granules.arn}/*"
       },
+      {
+        "Sid" : "AllowReceiveFromQueue",
+        "Effect" : "Allow",
+        "Action" : [
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:GetQueueAttributes"
+        ],
+        "Resource" : "${aws_sqs_queue.cnm_response.arn}"
+      },
       {
         "Sid" : "DescribeParameters",
         "Effect" : "Allow",
@@ -151,14 +222,6 @@ resource "aws_iam_policy" "aws_lambda_execution_policy" {
           "sns:Publish"
         ],
         "Resource" : "${data.aws_sns_topic.batch_job_failure.arn}"
-      },
-      {
-        "Sid" : "AllowListTopics",
-        "Effect" : "Allow",
-        "Action" : [
-          "sns:ListTopics"
-        ],
-        "Resource" : "*"
       }
     ]
   })
@@ -1,20 +1,24 @@
 """AWS Lambda that handles CNM responses published to an SNS Topic.
 
+CNM responses are delivered in batches from an SQS queue subscribed to the 
+topic.
+
 Deletes successfully ingested L2P granules from S3 bucket and EFS.
 Logs the errors.
 """
 
 # Standard imports
+import concurrent.futures
 import datetime
-import json
 import logging
-import pathlib
-import sys
+import os
 
 # Third-party imports
 import boto3
 import botocore
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 # Constants
 EFS = {
@@ -32,65 +36,36 @@ DATASET_DICT = {
     "MODIS_T": "MODIS_T-JPL-L2P-v2019.0",
     "VIIRS": "VIIRS_NPP-JPL-L2P-v2016.2"
 }
-OUTPUT = pathlib.Path("/mnt/data")
-TOPIC_STRING = "batch-job-failure"
+OUTPUT = "/mnt/data"
+CMR_UAT_URL = "https://cmr.uat.earthdata.nasa.gov/search/granules.umm_json"
+CMR_OPS_URL = "https://cmr.earthdata.nasa.gov/search/granules.umm_json"
+CMR_UAT_SUFFIXES = ("-sit", "-uat")
+TOPIC_ARN = os.environ["TOPIC_ARN"]
+SSM_EXTENSION_URL = "http://localhost:2773/systemsmanager/parameters/get"
+CMR_TIMEOUT = 30    # Seconds to wait on CMR connect and read
+SSM_EXTENSION_TIMEOUT = 5    # Seconds to wait on the parameters extension
+MIN_REMAINING_TIME = 60000    # Milliseconds needed to start handling another message
+
+class CnmResponderError(Exception):
+    """Raised when a CNM response could not be handled."""
+
+# AWS clients created once per execution environment and reused across invocations
+S3_CLIENT = boto3.client("s3")
+SNS_CLIENT = boto3.client("sns")
+
+# HTTP session kept open across invocations to reuse CMR connections
+CMR_SESSION = requests.Session()
+CMR_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# HTTP session kept open to the Parameters and Secrets Lambda Extension
+PARAMETER_SESSION = requests.Session()
 
-def cnm_handler(event, context):
-    """Handles CNM responses delivered from SNS Topic."""
-    
-    logger = get_logger()
-    logger.info(f"EVENT - {event}")
-    
-    # Parse message
-    response = json.loads(event["Records"][0]["Sns"]["Message"])
-    collection = response["collection"]
-    
-    # Determine success or failure
-    event_response = response["response"]["status"]
-    if event_response == "FAILURE":
-        message = f"{response['response']['errorCode']}: {response['response']['errorMessage']}"
-        handle_failure(message, response["identifier"], collection, logger)
-    else:
-        # Search
-        logger.info(f"Granule possibly ingested for: {collection}. Confirming now.")
-        if response["trace"].endswith("-sit") or response["trace"].endswith("-uat"):
-            cmr_url = "https://cmr.uat.earthdata.nasa.gov/search/granules.umm_json"
-        else:
-            cmr_url = "https://cmr.earthdata.nasa.gov/search/granules.umm_json"
-        granule_name = response["identifier"]
-        try:
-            token = get_edl_token(response["trace"], logger)
-        except botocore.exceptions.ClientError as error:
-            handle_failure(error, granule_name, collection, logger)
-        logger.info(f"Searching for {granule_name} from {collection}.")
-        checksum_dict = run_query(cmr_url, collection, granule_name, token, logger)
-        
-        # Remove file from S3 if present
-        if checksum_dict:
-            logger.info(f"Found {granule_name} from {collection}.")
-            try:
-                d_name = granule_name.split('-')[4]
-                if "VIIRS" in d_name: d_name = d_name.replace("_NPP", "")
-                dataset = S3[d_name]
-                checksum_errors = remove_staged_file(checksum_dict, response["trace"], dataset, response["product"]["files"], logger)
-                # Report on any files where checksums did not match
-                if len(checksum_errors) > 0: report_checksum_errors(checksum_errors, logger)
-            except botocore.exceptions.ClientError as error:
-                handle_failure(error, granule_name, collection, logger)
-        else:
-            message = f"Searched failed for {granule_name} from {collection}." 
-            handle_failure(message, granule_name, collection, logger)
-            
-        # Remove file from EFS output directory
-        logger.info(f"Removing {granule_name} from processor L2P output.")
-        remove_from_efs(f"{granule_name}.nc", logger)      
-    
 def get_logger():
     """Return a formatted logger object."""
     
     # Remove AWS Lambda logger
     logger = logging.getLogger()
-    for handler in logger.handlers:
+    for handler in list(logger.handlers):
         logger.removeHandler(handler)
     
     # Create a Logger object and set log level
@@ -110,57 +85,177 @@ def get_logger():
     # Return logger
     return logger
 
-def handle_failure(message, granule, collection, logger):
-    """Log CNM response failure message and send a notification."""
+# Logger configured once per execution environment
+LOGGER = get_logger()
+
+# Thread pools used to overlap independent S3 and EFS removals
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+EFS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def cnm_handler(event, context):
+    """Handles batches of CNM responses delivered from SQS queue.
+    
+    Returns SQS message identifiers of CNM responses that failed with a 
+    retryable error or whose failure notification could not be published so 
+    only those are retried. CNM FAILURE statuses and checksum mismatches are 
+    final and are acknowledged once their notification is published.
+    """
+    
+    LOGGER.info(f"EVENT - {event}")
+    
+    records = event["Records"]
+    batch_item_failures = []
+    notifications = []
+    try:
+        for i, record in enumerate(records):
+            # Leave remaining messages for retry rather than time out mid-batch
+            if context.get_remaining_time_in_millis() < MIN_REMAINING_TIME:
+                LOGGER.error(f"Insufficient time remaining; returning {len(records) - i} message(s) to queue.")
+                batch_item_failures.extend([{ "itemIdentifier": record["messageId"] } for record in records[i:]])
+                break
+            record_notifications = []
+            try:
+                handle_response(orjson.loads(record["body"]), record_notifications, LOGGER)
+            except CnmResponderError:
+                batch_item_failures.append({ "itemIdentifier": record["messageId"] })
+            except Exception as error:
+                LOGGER.exception(f"Error processing message {record['messageId']} - {error}")
+                batch_item_failures.append({ "itemIdentifier": record["messageId"] })
+            notifications.extend([(record["messageId"], message) for message in record_notifications])
+    finally:
+        # Send failure notifications accumulated across the batch and retry
+        # messages whose notification could not be published
+        if notifications:
+            retry_ids = { failure["itemIdentifier"] for failure in batch_item_failures }
+            for message_id in publish_events(notifications, LOGGER):
+                if message_id not in retry_ids:
+                    batch_item_failures.append({ "itemIdentifier": message_id })
+                    retry_ids.add(message_id)
+    
+    return { "batchItemFailures": batch_item_failures }
+
+def handle_response(response, notifications, logger):
+    """Handle a single CNM response.
+    
+    Failure notifications are appended to notifications list.
+    """
+    
+    collection = response["collection"]
+    
+    # Determine success or failure
+    event_response = response["response"]["status"]
+    if event_response == "FAILURE":
+        message = f"{response['response']['errorCode']}: {response['response']['errorMessage']}"
+        handle_failure(message, response["identifier"], collection, notifications, logger, retry=False)
+    else:
+        # Search
+        logger.info(f"Granule possibly ingested for: {collection}. Confirming now.")
+        cmr_url = CMR_UAT_URL if response["trace"][-4:] in CMR_UAT_SUFFIXES else CMR_OPS_URL
+        granule_name = response["identifier"]
+        try:
+            token = get_edl_token(response["trace"], logger)
+            logger.info(f"Searching for {granule_name} from {collection}.")
+            checksum_dict = run_query(cmr_url, collection, granule_name, token, logger)
+        except requests.exceptions.RequestException as error:
+            handle_failure(error, granule_name, collection, notifications, logger)
+        
+        # Remove file from S3 if present
+        if checksum_dict:
+            logger.info(f"Found {granule_name} from {collection}.")
+            parts = granule_name.split('-', 5)
+            d_name = parts[4]
+            if "VIIRS" in d_name: d_name = d_name.replace("_NPP", "")
+            ts = datetime.datetime.strptime(parts[0], "%Y%m%d%H%M%S")
+            dataset = S3[d_name]
+            keys, checksum_errors = compare_checksums(checksum_dict, dataset, response["product"]["files"])
+            try:
+                if len(checksum_errors) > 0:
+                    remove_staged_file(keys, response["trace"], logger)
+                else:
+                    # Remove file from S3 and EFS output directory concurrently
+                    logger.info(f"Removing {granule_name} from processor L2P output.")
+                    s3_future = EXECUTOR.submit(remove_staged_file, keys, response["trace"], logger)
+                    efs_future = EXECUTOR.submit(remove_from_efs, f"{granule_name}.nc", d_name, ts, logger)
+                    efs_future.result()
+                    s3_future.result()
+            except (botocore.exceptions.ClientError, CnmResponderError) as error:
+                handle_failure(error, granule_name, collection, notifications, logger)
+            # Report on any files where checksums did not match
+            if len(checksum_errors) > 0:
+                message = report_checksum_errors(checksum_errors, logger)
+                handle_failure(message, granule_name, collection, notifications, logger, retry=False)
+        else:
+            message = f"Searched failed for {granule_name} from {collection}." 
+            handle_failure(message, granule_name, collection, notifications, logger)
+    
+def handle_failure(message, granule, collection, notifications, logger, retry=True):
+    """Log CNM response failure message and queue a notification.
+    
+    Raises CnmResponderError if retry is True so the message is returned to the
+    queue; final failures are acknowledged.
+    """
     
     logger.error(f"Cumulus ingestion failed for {granule} in {collection}")
     logger.error(message)
     error_message = f"Cumulus ingestion failed for {granule} in {collection}.\n" \
-        + message
-    publish_event(error_message, logger)
-    logger.error("Exiting program.")
-    sys.exit(1)
+        + str(message)
+    notifications.append(error_message)
+    if retry: raise CnmResponderError(error_message)
     
-def publish_event(error_msg, logger):
-    """Publish event to SNS Topic."""
+def publish_events(notifications, logger):
+    """Publish events to SNS Topic in batches of up to 10 messages.
     
-    sns = boto3.client("sns")
+    Notifications are (SQS message identifier, error message) pairs. Returns 
+    list of SQS message identifiers whose notification was not published.
+    """
     
-    # Get topic ARN
-    try:
-        topics = sns.list_topics()
-    except botocore.exceptions.ClientError as e:
-        logger.error("Failed to list SNS Topics.")
-        logger.error(f"Error - {e}")
-        sys.exit(1)
-    for topic in topics["Topics"]:
-        if TOPIC_STRING in topic["TopicArn"]:
-            topic_arn = topic["TopicArn"]
-            
-    # Publish to topic
     subject = f"Generate Failure: CNM Responder"
-    try:
-        response = sns.publish(
-            TopicArn = topic_arn,
-            Message = error_msg,
-            Subject = subject
-        )
-    except botocore.exceptions.ClientError as e:
-        logger.error(f"Failed to publish to SNS Topic: {topic_arn}.")
-        logger.error(f"Error - {e}")
-        sys.exit(1)
+    unpublished = []
+    for i in range(0, len(notifications), 10):
+        chunk = notifications[i:i + 10]
+        entries = [
+            { "Id": str(j), "Message": error_msg, "Subject": subject } 
+            for j, (_, error_msg) in enumerate(chunk)
+        ]
+        try:
+            response = SNS_CLIENT.publish_batch(
+                TopicArn = TOPIC_ARN,
+                PublishBatchRequestEntries = entries
+            )
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            logger.error(f"Failed to publish to SNS Topic: {TOPIC_ARN}.")
+            logger.error(f"Error - {e}")
+            unpublished.extend([message_id for message_id, _ in chunk])
+            continue
+        for failed in response.get("Failed", []):
+            message_id = chunk[int(failed["Id"])][0]
+            logger.error(f"Failed to publish notification for message {message_id} to SNS Topic: {TOPIC_ARN}.")
+            logger.error(f"Error - {failed['Code']}: {failed.get('Message', '')}")
+            unpublished.append(message_id)
+        if len(response.get("Successful", [])) > 0:
+            logger.info(f"{len(response['Successful'])} message(s) published to SNS Topic: {TOPIC_ARN}.")
     
-    logger.info(f"Message published to SNS Topic: {topic_arn}.")
+    return unpublished
     
 def get_edl_token(prefix, logger):
-    """Retrieve EDL bearer token from SSM parameter store."""
+    """Retrieve EDL bearer token from SSM parameter store.
+    
+    Token is read through the Parameters and Secrets Lambda Extension which
+    caches the decrypted value in the execution environment.
+    """
     
     try:
-        ssm_client = boto3.client('ssm', region_name="us-west-2")
-        token = ssm_client.get_parameter(Name=f"{prefix}-edl-token", WithDecryption=True)["Parameter"]["Value"]
+        res = PARAMETER_SESSION.get(
+            url=SSM_EXTENSION_URL,
+            headers={ "X-Aws-Parameters-Secrets-Token": os.environ["AWS_SESSION_TOKEN"] },
+            params={ "name": f"{prefix}-edl-token", "withDecryption": "true" },
+            timeout=SSM_EXTENSION_TIMEOUT
+        )
+        res.raise_for_status()
+        token = res.json()["Parameter"]["Value"]
         logger.info("Retrieved EDL token.")
         return token
-    except botocore.exceptions.ClientError as error:
+    except requests.exceptions.RequestException as error:
         logger.error("Could not retrieve EDL credentials from SSM Parameter Store.")
         raise error
 
@@ -168,37 +263,49 @@ def run_query(cmr_url, collection, granule_name, token, logger):
     """Run query on granule to see if it exists in CMR.
     
     Returns dict of file and md5 checksums or empty dict if no granule is found.
+    Raises HTTPError if CMR rejects the EDL token.
     """
 
     # Search for granule
     headers = { "Authorization": f"Bearer {token}" }
     params = {
         "short_name": collection,
-        "readable_granule_name": granule_name
+        "readable_granule_name": granule_name,
+        "page_size": 1
     }
-    res = requests.post(url=cmr_url, headers=headers, params=params)        
-    coll = res.json()
+    res = CMR_SESSION.get(url=cmr_url, headers=headers, params=params, timeout=CMR_TIMEOUT)
+    if res.status_code == 401:
+        logger.error("CMR rejected EDL token.")
+        res.raise_for_status()
+    coll = orjson.loads(res.content)
 
     # Parse response to locate granule checksums
-    if "errors" in coll.keys():
+    if "errors" in coll:
         logger.error(f"Error response - {coll['errors']}")
         return {}
-    elif "hits" in coll.keys() and coll["hits"] > 0:
+    elif "hits" in coll and coll["hits"] > 0:
         files = coll["items"][0]["umm"]["DataGranule"]["ArchiveAndDistributionInformation"]
         checksum_dict = {}
         for file in files:
-            if file["Name"].endswith(".nc"):
+            name = file["Name"]
+            if name.endswith(".nc"):
                 checksum_dict["netcdf"] = file["Checksum"]["Value"]
-            if file["Name"].endswith(".md5"):
+            elif name.endswith(".md5"):
                 checksum_dict["md5"] = file["Checksum"]["Value"]
+            if len(checksum_dict) == 2: break
         return checksum_dict
     else:
         logger.error(f"Could not locate granule: {granule_name}")
         return {}
     
-def remove_staged_file(checksum_dict, prefix, dataset, file_list, logger):
-    """Remove files that were staged in L2P granules S3 bucket."""
+def compare_checksums(checksum_dict, dataset, file_list):
+    """Compare staged file checksums to checksums found in CMR.
+    
+    Returns list of S3 keys with matching checksums and list of file names 
+    where checksums did not match.
+    """
     
+    keys = []
     checksum_errors = []
     for file in file_list:
         if file["name"].endswith(".nc"):
@@ -207,58 +314,87 @@ def remove_staged_file(checksum_dict, prefix, dataset, file_list, logger):
             file_type = "md5"
         else:
             continue 
-        # Remove file from S3 if checksums match
         if file["checksum"] == checksum_dict[file_type]:
-            try:
-                s3 = boto3.client("s3")
-                response = s3.delete_object(
-                    Bucket=f"{prefix}-l2p-granules",
-                    Key=f"{dataset}/{file['name']}"
-                )
-                logger.info(f"{dataset}/{file['name']} deleted from L2P granules staging bucket.")
-            except botocore.exceptions.ClientError as error:
-                logger.error(f"Error encountered deleting file: {file['name']}")
-                raise error
+            keys.append(f"{dataset}/{file['name']}")
         else:
             checksum_errors.append(file["name"])
             
-    return checksum_errors
+    return keys, checksum_errors
+
+def remove_staged_file(keys, prefix, logger):
+    """Remove files that were staged in L2P granules S3 bucket."""
+    
+    to_delete = [{ "Key": key } for key in keys]
+    
+    # Delete all matching files in a single request
+    if to_delete:
+        try:
+            response = S3_CLIENT.delete_objects(
+                Bucket=f"{prefix}-l2p-granules",
+                Delete={ "Objects": to_delete, "Quiet": True }
+            )
+        except botocore.exceptions.ClientError as error:
+            logger.error(f"Error encountered deleting files: {', '.join([obj['Key'] for obj in to_delete])}")
+            raise error
+        errors = response.get("Errors", [])
+        failed = { error["Key"] for error in errors }
+        for error in errors:
+            logger.error(f"Error encountered deleting file: {error['Key']} - {error['Code']}: {error['Message']}")
+        for obj in to_delete:
+            if obj["Key"] not in failed:
+                logger.info(f"{obj['Key']} deleted from L2P granules staging bucket.")
+        if errors:
+            raise CnmResponderError(f"Failed to delete from L2P granules staging bucket: {', '.join(sorted(failed))}")
         
 def report_checksum_errors(checksum_errors, logger):
-    """Report on cases where S3 checksum did not match CMR checksum."""
+    """Report on cases where S3 checksum did not match CMR checksum.
+    
+    Returns failure message.
+    """
     
     logger.error("The following checksums created during Generate processing did not match checksums found in CMR...")
     for file in checksum_errors:
         logger.error(file)
-    sys.exit(1)
+    return f"Checksums did not match for: {', '.join(checksum_errors)}"
     
-def remove_from_efs(granule_name, logger):
-    """Remove L2P granule from processor output directory."""
+def remove_from_efs(granule_name, dataset, ts, logger):
+    """Remove L2P granule from processor output directory.
     
-    dataset = granule_name.split('-')[4]
-    if "VIIRS" in dataset: dataset = dataset.replace("_NPP", "")
-    ts = datetime.datetime.strptime(granule_name.split('-')[0], "%Y%m%d%H%M%S")
-
-    granule_file = OUTPUT.joinpath(EFS[dataset], dataset, str(ts.year), str(ts.timetuple().tm_yday), granule_name)   
-    delete_file(granule_file, logger)
-        
-    checksum = OUTPUT.joinpath(EFS[dataset], dataset, str(ts.year), str(ts.timetuple().tm_yday), f"{granule_name}.md5")
-    delete_file(checksum, logger)
+    Dataset and timestamp are parsed from the granule name by the caller.
+    """
+    
+    names = { granule_name, f"{granule_name}.md5" }
+    tt = ts.timetuple()
+    year = str(tt.tm_year)
+    yday = str(tt.tm_yday)
+    dataset_dir = os.path.join(OUTPUT, EFS[dataset])
+    dir_base = os.path.join(dataset_dir, dataset, year, yday)
+    dir_refined = os.path.join(dataset_dir, f"{dataset}_REFINED", year, yday)
+    
+    # List both directories and then delete all matches in parallel
+    found = EFS_EXECUTOR.map(lambda directory: find_files(directory, names, logger), (dir_base, dir_refined))
+    paths = [path for matches in found for path in matches]
+    list(EFS_EXECUTOR.map(lambda path: delete_file(path, logger), paths))
     
-    granule_file_refined = OUTPUT.joinpath(EFS[dataset], f"{dataset}_REFINED", str(ts.year), str(ts.timetuple().tm_yday), granule_name)
-    delete_file(granule_file_refined, logger)
+def find_files(directory, names, logger):
+    """List directory once and return paths of entries matching names."""
     
-    checksum_refined = OUTPUT.joinpath(EFS[dataset], f"{dataset}_REFINED", str(ts.year), str(ts.timetuple().tm_yday), f"{granule_name}.md5")
-    delete_file(checksum_refined, logger)
+    try:
+        with os.scandir(directory) as entries:
+            matches = [entry for entry in entries if entry.name in names]
+    except FileNotFoundError:
+        matches = []
+    
+    for name in sorted(names - { entry.name for entry in matches }):
+        logger.info(f"{os.path.join(directory, name)} does not exist on the EFS.")
+    
+    return [entry.path for entry in matches]
 
 def delete_file(granule, logger):
-    """Determine if granule file exists and delete if it does.
-    
-    Returns granule name if does not exist else None.
-    """
+    """Delete granule file path if it exists."""
     
     try:
-        granule.unlink()
-        logger.info(f"Removed {str(granule)} from EFS.")
+        os.unlink(granule)
+        logger.info(f"Removed {granule} from EFS.")
     except FileNotFoundError:
-        logger.info(f"{str(granule)} does not exist on the EFS.")
+        logger.info(f"{granule} does not exist on the EFS.")
\ No newline at end of file
@@ -26,6 +26,12 @@ variable "environment" {
   description = "The environment in which to deploy to"
 }
 
+variable "parameters_secrets_extension_version" {
+  type        = number
+  description = "Version of the AWS Parameters and Secrets Lambda Extension layer"
+  default     = 11
+}
+
 variable "prefix" {
   type        = string
   description = "Prefix to add to all AWS resources as a unique identifier"